@@ -0,0 +1,153 @@
+# gemini_client.py
+import os
+import re
+import json
+import time
+import random
+import hashlib
+import functools
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+try:
+    from google.api_core import exceptions as gexc
+    _RETRYABLE = (
+        gexc.ResourceExhausted,
+        gexc.ServiceUnavailable,
+        gexc.InternalServerError,
+        gexc.DeadlineExceeded,
+    )
+except Exception:
+    _RETRYABLE = ()
+
+try:
+    import google.generativeai as genai
+except Exception as e:
+    genai = None
+    print(f"[gemini_client] google.generativeai unavailable: {e}")
+
+_CACHE_SIZE = int(os.environ.get("GEMINI_CACHE_SIZE", 1024))
+
+# Calls in flight across all threads, so bursts queue here instead of tripping quota.
+_MAX_CONCURRENCY = int(os.environ.get("GEMINI_MAX_CONCURRENCY", 8))
+_MAX_ATTEMPTS = 4
+_BACKOFF_BASE = 0.5
+_BACKOFF_MAX = 8.0
+
+_call_slots = threading.BoundedSemaphore(_MAX_CONCURRENCY)
+
+# Grading expects a short JSON object; greedy decoding keeps scores repeatable
+# and the token cap stops the decoder from rambling past it. JSON mode with a
+# schema makes the model emit the object itself rather than fenced prose.
+_GRADING_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "score": {"type": "number"},
+        "justification": {"type": "string"},
+    },
+    "required": ["score", "justification"],
+}
+_GRADING_CONFIG = {
+    "temperature": 0.0,
+    "max_output_tokens": 256,
+    "response_mime_type": "application/json",
+    "response_schema": _GRADING_SCHEMA,
+}
+
+# Markdown code fence wrapped around a model reply, e.g. ```json ... ```
+_FENCE_RE = re.compile(r"^```(?:json)?\s*|\s*```$", re.IGNORECASE)
+
+_cache: "OrderedDict[bytes, dict]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def _configure() -> None:
+    genai.configure(api_key=os.environ.get("GEMINI_API_KEY"))
+
+
+@functools.lru_cache(maxsize=None)
+def _load_model(model_name: str):
+    # Failures are cached too, so an unconfigured SDK is reported once per
+    # process rather than once per graded answer.
+    try:
+        if genai is None:
+            raise RuntimeError("google.generativeai is not installed")
+        _configure()
+        return genai.GenerativeModel(model_name), None
+    except Exception as e:
+        print(f"[gemini_client] Gemini not configured for {model_name}: {e}")
+        return None, str(e)
+
+
+def get_model(model_name: str):
+    """
+    Returns the process-wide GenerativeModel for model_name, configuring the SDK
+    on first use. Raises if the SDK is missing or the model cannot be built.
+    """
+    model, error = _load_model(model_name)
+    if model is None:
+        raise RuntimeError(f"Gemini not configured: {error}")
+    return model
+
+
+def _cache_key(model_name: str, prompt: str) -> bytes:
+    raw = repr((model_name, prompt)).encode("utf-8")
+    return hashlib.blake2b(raw, digest_size=16).digest()
+
+
+def strip_code_fences(text: str) -> str:
+    """Removes a leading ```/```json fence and a trailing ``` fence in one pass."""
+    return _FENCE_RE.sub("", text.strip())
+
+
+def _generate_with_retry(model, prompt: str, generation_config: Optional[dict]):
+    for attempt in range(1, _MAX_ATTEMPTS + 1):
+        try:
+            with _call_slots:
+                return model.generate_content(prompt, generation_config=generation_config)
+        except _RETRYABLE:
+            if attempt == _MAX_ATTEMPTS:
+                raise
+            delay = min(_BACKOFF_MAX, _BACKOFF_BASE * (2 ** (attempt - 1)))
+            time.sleep(delay * random.uniform(0.5, 1.0))
+
+
+def generate_text(model, prompt: str, generation_config: Optional[dict] = None) -> str:
+    """
+    Runs model.generate_content(prompt) and returns the response text.
+    At most GEMINI_MAX_CONCURRENCY calls run at once; quota and transient server
+    errors are retried with jittered exponential backoff.
+    """
+    resp = _generate_with_retry(model, prompt, generation_config)
+    return getattr(resp, "text", "") or str(resp)
+
+
+def grade_json(model_name: str, prompt: str) -> dict:
+    """
+    Asks model_name for a {"score", "justification"} JSON object and returns it
+    as {'score': float(0..1), 'justification': str}.
+    Raises if the model is unavailable or the reply is not valid JSON.
+    Parsed grades are kept in an in-process LRU keyed on (model, prompt), so
+    retried tasks and re-grades of identical answers skip the network call;
+    a reply that fails to parse is not cached and is asked for again next time.
+    """
+    key = _cache_key(model_name, prompt)
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return dict(_cache[key])
+
+    text = generate_text(get_model(model_name), prompt, _GRADING_CONFIG)
+    parsed = json.loads(strip_code_fences(text))
+    s = float(parsed.get('score', 0.0))
+    j = parsed.get('justification', '') or ''
+    result = {'score': max(0.0, min(1.0, s)), 'justification': j}
+
+    with _cache_lock:
+        _cache[key] = result
+        _cache.move_to_end(key)
+        while len(_cache) > _CACHE_SIZE:
+            _cache.popitem(last=False)
+    return dict(result)
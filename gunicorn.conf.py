@@ -0,0 +1,30 @@
+# gunicorn.conf.py
+# Picked up automatically by `gunicorn worker:app` when run from this directory.
+import os
+
+# ----------------- Server -----------------
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+
+# Tasks spend nearly all their time waiting on Drive, Vision, Firestore and
+# Gemini, so a few processes with many threads each keeps the CPU busy.
+worker_class = 'gthread'
+workers = int(os.environ.get('GUNICORN_WORKERS', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+# Multi-page OCR plus grading can take minutes; Cloud Tasks retries on timeout.
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 600))
+graceful_timeout = 30
+keepalive = 5
+
+
+# ----------------- Hooks -----------------
+def post_worker_init(worker):
+    # Open the Vision gRPC channel and load the Drive discovery document in each
+    # worker process (gRPC channels must not cross a fork) before the first task.
+    try:
+        from utils import get_vision_client
+        from worker import get_drive_service
+        get_vision_client()
+        get_drive_service()
+    except Exception as e:
+        worker.log.warning("Client warm-up failed, will retry on first task: %s", e)
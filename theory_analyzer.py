@@ -1,14 +1,25 @@
 # theory_analyzer.py
-import os
-import json
+import re
 
-try:
-    import google.generativeai as genai
-    genai.configure(api_key=os.environ.get("GEMINI_API_KEY"))
-    grading_model = genai.GenerativeModel('gemini-1.5-pro-latest')
-except Exception as e:
-    grading_model = None
-    print(f"[theory_analyzer] Gemini not configured: {e}")
+from gemini_client import grade_json
+
+_GRADING_MODEL_NAME = 'gemini-1.5-pro-latest'
+
+# Heuristic fallback keywords: whitespace-delimited words of 3+ characters,
+# with surrounding punctuation trimmed.
+_KEYWORD_RE = re.compile(r"\S{3,}")
+_KEYWORD_STRIP = ".,;()[]"
+
+# Any letter or digit; answers without one are OCR noise (stray marks, rules, dots).
+_READABLE_RE = re.compile(r"[^\W_]")
+
+
+def _keyword_set(text: str) -> set:
+    return {w.strip(_KEYWORD_STRIP) for w in _KEYWORD_RE.findall(text.lower())}
+
+
+def _is_gradeable(text: str) -> bool:
+    return _READABLE_RE.search(text) is not None
 
 def analyze_theory_submission(question: str, student_answer_ocr: str) -> dict:
     """
@@ -17,30 +28,24 @@ def analyze_theory_submission(question: str, student_answer_ocr: str) -> dict:
     """
     if not student_answer_ocr or not student_answer_ocr.strip():
         return {'score': 0.0, 'justification': 'No answer submitted.'}
+    if not _is_gradeable(student_answer_ocr):
+        return {'score': 0.0, 'justification': 'Answer has no readable content.'}
 
-    if grading_model:
-        prompt = f"""
+    prompt = f"""
 You are a strict university instructor. Grade the student's short-answer against the question.
 Return a single JSON object with "score" (0.0-1.0) and "justification" (one short sentence).
 Question: "{question}"
 Student Answer: "{student_answer_ocr}"
 """
-        try:
-            resp = grading_model.generate_content(prompt)
-            text = getattr(resp, "text", "") or str(resp)
-            cleaned = text.strip().replace("```json", "").replace("```", "").strip()
-            parsed = json.loads(cleaned)
-            # normalize parsed content
-            s = float(parsed.get('score', 0.0))
-            j = parsed.get('justification', '') or ''
-            return {'score': max(0.0, min(1.0, s)), 'justification': j}
-        except Exception:
-            # fall through to heuristic below
-            pass
+    try:
+        return grade_json(_GRADING_MODEL_NAME, prompt)
+    except Exception:
+        # Gemini unavailable or reply unusable: fall through to heuristic below
+        pass
 
     # Simple heuristic fallback: check overlap of keywords from question and answer
-    q_words = set(w.lower().strip(".,;()[]") for w in (question or "").split() if len(w) > 2)
-    a_words = set(w.lower().strip(".,;()[]") for w in (student_answer_ocr or "").split() if len(w) > 2)
+    q_words = _keyword_set(question or "")
+    a_words = _keyword_set(student_answer_ocr or "")
     if not q_words:
         return {'score': 0.0, 'justification': 'Question not provided.'}
     overlap = len(q_words & a_words)
@@ -1,6 +1,99 @@
 # utils.py
 from google.cloud import vision
+from concurrent.futures import ThreadPoolExecutor
 import io
+import os
+import logging
+import threading
+
+# Online batch_annotate_files annotates at most 5 pages of a file per request.
+_PDF_PAGES_PER_REQUEST = 5
+_PDF_OCR_WORKERS = int(os.environ.get("PDF_OCR_WORKERS", 4))
+
+# Leading bytes of the formats Vision reads, checked before trusting a file name.
+_MAGIC_NUMBERS = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"II*\x00", "image/tiff"),
+    (b"MM\x00*", "image/tiff"),
+    (b"BM", "image/bmp"),
+)
+
+logger = logging.getLogger(__name__)
+
+_vision_client = None
+_vision_client_lock = threading.Lock()
+
+
+def get_vision_client() -> vision.ImageAnnotatorClient:
+    """
+    Returns the process-wide Vision client, creating it on first use.
+    The client holds the gRPC channel, so reusing it avoids a new connection
+    and auth handshake per extracted file.
+    """
+    global _vision_client
+    if _vision_client is None:
+        with _vision_client_lock:
+            if _vision_client is None:
+                _vision_client = vision.ImageAnnotatorClient()
+    return _vision_client
+
+
+def sniff_mime_type(file_content: bytes):
+    """
+    Identifies PDFs and common image formats from their leading bytes.
+    Returns the MIME type, or None if the content is not recognised.
+    """
+    head = file_content[:16]
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    for magic, mime_type in _MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return mime_type
+    # Checked after the exact image signatures, since image data can contain
+    # "%PDF": PDF readers accept junk before the header if it starts within 1 KB.
+    if b"%PDF" in file_content[:1024]:
+        return "application/pdf"
+    return None
+
+
+def _annotate_pdf_pages(client, file_content: bytes, pages: list = None):
+    """
+    Runs document text detection on the given 1-based pages of a PDF
+    (the first 5 pages when no pages are given).
+    Returns (page_texts, total_pages).
+    """
+    input_config = vision.InputConfig(content=file_content, mime_type='application/pdf')
+    feature = vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)
+    request = vision.AnnotateFileRequest(input_config=input_config, features=[feature], pages=pages or [])
+    response = client.batch_annotate_files(requests=[request])
+    pages_text = []
+    total_pages = 0
+    # response.responses is a list of AnnotateFileResponse; each has responses per page
+    for resp in response.responses:
+        total_pages = max(total_pages, resp.total_pages)
+        # resp.responses is list of AnnotateImageResponse for each page
+        for page_resp in resp.responses:
+            if page_resp.error.message:
+                raise Exception(page_resp.error.message)
+            if page_resp.full_text_annotation and page_resp.full_text_annotation.text:
+                pages_text.append(page_resp.full_text_annotation.text)
+    return pages_text, total_pages
+
+
+def _annotate_pdf_range(client, file_content: bytes, pages: list) -> list:
+    """
+    Like _annotate_pdf_pages for one later page range, but a failure (e.g. a
+    quota error) drops only that range's text instead of the whole document.
+    """
+    try:
+        return _annotate_pdf_pages(client, file_content, pages)[0]
+    except Exception as e:
+        logger.error(f"PDF OCR failed for pages {pages[0]}-{pages[-1]}: {e}")
+        return []
+
 
 def extract_text_from_file(file_content: bytes, mime_type: str) -> str:
     """
@@ -10,7 +103,7 @@ def extract_text_from_file(file_content: bytes, mime_type: str) -> str:
     if not file_content:
         return ""
 
-    client = vision.ImageAnnotatorClient()
+    client = get_vision_client()
 
     try:
         # Images: single image text detection (document_text_detection)
@@ -21,22 +114,17 @@ def extract_text_from_file(file_content: bytes, mime_type: str) -> str:
                 raise Exception(response.error.message)
             return response.full_text_annotation.text or ""
 
-        # PDF: use batch_annotate_files and combine page texts
+        # PDF: annotate the first pages, then fetch the remaining page ranges concurrently
         if mime_type == 'application/pdf' or (mime_type is None and file_content[:4] == b"%PDF"):
-            # annotate file
-            input_config = vision.InputConfig(content=file_content, mime_type='application/pdf')
-            feature = vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)
-            request = vision.AnnotateFileRequest(input_config=input_config, features=[feature])
-            response = client.batch_annotate_files(requests=[request])
-            # response.responses is a list of AnnotateFileResponse; each has responses per page
-            pages_text = []
-            for resp in response.responses:
-                # resp.responses is list of AnnotateImageResponse for each page
-                for page_resp in resp.responses:
-                    if page_resp.error.message:
-                        raise Exception(page_resp.error.message)
-                    if page_resp.full_text_annotation and page_resp.full_text_annotation.text:
-                        pages_text.append(page_resp.full_text_annotation.text)
+            pages_text, total_pages = _annotate_pdf_pages(client, file_content)
+            page_ranges = [
+                list(range(start, min(start + _PDF_PAGES_PER_REQUEST, total_pages + 1)))
+                for start in range(_PDF_PAGES_PER_REQUEST + 1, total_pages + 1, _PDF_PAGES_PER_REQUEST)
+            ]
+            if page_ranges:
+                with ThreadPoolExecutor(max_workers=min(_PDF_OCR_WORKERS, len(page_ranges))) as pool:
+                    for texts in pool.map(lambda p: _annotate_pdf_range(client, file_content, p), page_ranges):
+                        pages_text.extend(texts)
             return "\n\n--- Page Break ---\n\n".join(pages_text)
 
         # fallback: try single-image annotate
@@ -5,19 +5,28 @@ import re
 import json
 import hashlib
 import logging
+import mimetypes
 import string
+import functools
+import threading
+import time
 import traceback
-from typing import List, Dict, Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Dict, Optional, Tuple
 
 from flask import Flask, request, jsonify
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
+from googleapiclient.http import MediaIoBaseDownload, build_http
 import google.oauth2.credentials
+import google_auth_httplib2
+import httplib2
+from google.api_core.exceptions import AlreadyExists
 from google.cloud import firestore
 
 from programming_analyzer import analyze_programming_submission
 from theory_analyzer import analyze_theory_submission
-from utils import extract_text_from_file
+from utils import extract_text_from_file, sniff_mime_type
 
 
 # ----------------- Logging -----------------
@@ -30,20 +39,70 @@ db = firestore.Client()
 # ----------------- Flask -----------------
 app = Flask(__name__)
 
+# ----------------- Concurrency -----------------
+_DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', 8))
+# Retries (with the client library's exponential backoff) on 5xx/429 and connection errors.
+_DRIVE_RETRIES = int(os.environ.get('DRIVE_RETRIES', 3))
+# Shared across tasks so each thread's keep-alive Drive connection is reused.
+_DOWNLOAD_POOL = ThreadPoolExecutor(max_workers=_DOWNLOAD_WORKERS, thread_name_prefix='drive-download')
+_OCR_WORKERS = int(os.environ.get('OCR_WORKERS', 8))
+# Kept separate from (and smaller than) the OCR pool: analyzers hit rate-limited LLM APIs.
+_ANALYZER_WORKERS = int(os.environ.get('ANALYZER_WORKERS', 4))
+# OCR cache writes are off the response path: nothing in the task reads them back.
+_WRITE_POOL = ThreadPoolExecutor(max_workers=int(os.environ.get('WRITE_WORKERS', 4)), thread_name_prefix='ocr-cache-write')
+# OCR text keyed by file hash, shared across students, resubmissions and retries.
+# Firestore documents top out at 1 MiB, so larger texts are not cached.
+_OCR_CACHE_COLLECTION = 'ocr_cache'
+_OCR_CACHE_MAX_BYTES = 1_000_000
+# '{assignment_id}_{file hash}' -> first submitter; turns the plagiarism lookup into
+# keyed reads. Results written before the index existed are only found by the
+# file_hashes query, which PLAGIARISM_INDEX_ONLY=1 turns off once backfilled.
+_PLAGIARISM_INDEX_COLLECTION = 'plagiarism_index'
+_PLAGIARISM_INDEX_ONLY = os.environ.get('PLAGIARISM_INDEX_ONLY', '0') == '1'
+# Firestore caps the number of values in an array_contains_any filter.
+_ARRAY_CONTAINS_ANY_LIMIT = 30
+
+# ----------------- Credentials Cache -----------------
+# One Credentials object per OAuth grant, so an access token refreshed by one
+# task is reused by the next task for the same teacher instead of refreshed again.
+_CREDENTIALS_CACHE_SIZE = int(os.environ.get('CREDENTIALS_CACHE_SIZE', 256))
+_credentials: "OrderedDict[str, google.oauth2.credentials.Credentials]" = OrderedDict()
+_credentials_lock = threading.Lock()
+
+# ----------------- Plagiarism Cache -----------------
+# (assignment_id, file hash) -> (owner student_id, owner doc id, expiry). Lets warm
+# workers answer retries and resubmissions without querying Firestore.
+_HASH_OWNER_CACHE_SIZE = int(os.environ.get('HASH_OWNER_CACHE_SIZE', 10000))
+_HASH_OWNER_TTL = float(os.environ.get('HASH_OWNER_TTL', 3600))
+_hash_owners: "OrderedDict[Tuple[str, str], Tuple[str, str, float]]" = OrderedDict()
+_hash_owners_lock = threading.Lock()
+# Hashes shared by unrelated students for innocent reasons: the empty file, plus
+# any starter/template files listed in TRIVIAL_FILE_HASHES (comma-separated).
+_TRIVIAL_HASHES = frozenset(
+    [hashlib.sha256(b'').hexdigest()]
+    + [h.strip() for h in os.environ.get('TRIVIAL_FILE_HASHES', '').split(',') if h.strip()]
+)
+
 # ----------------- Stopwords -----------------
-_STOPWORDS = set([
+_STOPWORDS = frozenset([
     'the','a','an','and','or','to','of','in','on','for','with','by','from',
     'that','this','it','is','are','as','be','your','student','write','implement','print'
 ])
 
+# ----------------- Patterns -----------------
+# A token is any run of characters that is neither whitespace nor ASCII punctuation.
+_WORD_RE = re.compile(r'[^\s' + re.escape(string.punctuation) + r']+')
+
+_PART_MARKER_RE = re.compile(
+    r'^\s*(?:P?\s?\d+[:.\)]|Part\s*\d+[:.\)]|\([a-zA-Z0-9]\)|[a-zA-Z]\)|Q\d+[:.\)])',
+    re.IGNORECASE
+)
+
 # ----------------- Helpers -----------------
 def token_set(text: str) -> set:
     if not text:
         return set()
-    t = text.lower()
-    t = t.translate(str.maketrans(string.punctuation, ' '*len(string.punctuation)))
-    toks = [w for w in t.split() if w and w not in _STOPWORDS]
-    return set(toks)
+    return {w for w in _WORD_RE.findall(text.lower()) if w not in _STOPWORDS}
 
 def split_question_into_parts(question: str) -> List[str]:
     if not question or not question.strip():
@@ -51,16 +110,12 @@ def split_question_into_parts(question: str) -> List[str]:
     lines = [l.rstrip() for l in question.splitlines() if l.strip()]
     parts = []
     current = []
-    marker_regex = re.compile(
-        r'^\s*(?:P?\s?\d+[:.\)]|Part\s*\d+[:.\)]|\([a-zA-Z0-9]\)|[a-zA-Z]\)|Q\d+[:.\)])',
-        re.IGNORECASE
-    )
     for line in lines:
-        if marker_regex.match(line):
+        m = _PART_MARKER_RE.match(line)
+        if m:
             if current:
                 parts.append(" ".join(current).strip())
-            cleaned = re.sub(marker_regex, '', line).strip()
-            current = [cleaned]
+            current = [line[m.end():].strip()]
         else:
             current.append(line)
     if current:
@@ -69,6 +124,337 @@ def split_question_into_parts(question: str) -> List[str]:
         return [question.strip()]
     return [p for p in parts if p] or [question.strip()]
 
+@functools.lru_cache(maxsize=256)
+def question_layout(question: str) -> Tuple[Tuple[str, ...], frozenset, Dict[str, Tuple[int, ...]], Tuple[int, ...]]:
+    """
+    Returns (parts, vocabulary, token -> indices of parts containing it, part token counts).
+    Every student's task for an assignment carries the same question text.
+    """
+    parts = tuple(split_question_into_parts(question))
+    q_tokens = [token_set(p) for p in parts]
+    token_parts: Dict[str, List[int]] = {}
+    for j, qt in enumerate(q_tokens):
+        for w in qt:
+            token_parts.setdefault(w, []).append(j)
+    return (
+        parts,
+        frozenset(token_parts),
+        {w: tuple(js) for w, js in token_parts.items()},
+        tuple(len(qt) or 1 for qt in q_tokens),
+    )
+
+def attachment_file(att: dict) -> Tuple[Optional[str], Optional[str]]:
+    drive_file = att.get('driveFile') or att.get('drive_file') or att
+    if isinstance(drive_file, dict):
+        return drive_file.get('id'), drive_file.get('title') or drive_file.get('name')
+    return None, None
+
+class _HashingBytesIO(io.BytesIO):
+    """BytesIO that hashes bytes as they are written, so downloads need no second pass."""
+
+    def __init__(self):
+        super().__init__()
+        self.sha256 = hashlib.sha256()
+
+    def write(self, b):
+        self.sha256.update(b)
+        return super().write(b)
+
+_http_local = threading.local()
+
+def _thread_http() -> httplib2.Http:
+    # httplib2 connections are not thread-safe, so each thread keeps its own.
+    # build_http sets the client library's socket timeout, so a stalled
+    # connection raises (and is retried) instead of holding the thread.
+    http = getattr(_http_local, 'http', None)
+    if http is None:
+        http = _http_local.http = build_http()
+    return http
+
+def get_credentials(credentials_info: dict) -> google.oauth2.credentials.Credentials:
+    refresh_token = credentials_info.get('refresh_token')
+    if not refresh_token:
+        return google.oauth2.credentials.Credentials(**credentials_info)
+    key = hashlib.blake2b(json.dumps([
+        refresh_token,
+        credentials_info.get('client_id'),
+        credentials_info.get('client_secret'),
+        credentials_info.get('token_uri'),
+    ]).encode(), digest_size=16).hexdigest()
+
+    with _credentials_lock:
+        creds = _credentials.get(key)
+        if creds is not None:
+            _credentials.move_to_end(key)
+            return creds
+    creds = google.oauth2.credentials.Credentials(**credentials_info)
+    with _credentials_lock:
+        creds = _credentials.setdefault(key, creds)
+        _credentials.move_to_end(key)
+        while len(_credentials) > _CREDENTIALS_CACHE_SIZE:
+            _credentials.popitem(last=False)
+    return creds
+
+@functools.lru_cache(maxsize=1)
+def get_drive_service():
+    # Built once from the bundled discovery document. Requests never use this
+    # http; each one is executed with the caller's authorized transport.
+    return build('drive', 'v3', http=build_http(), cache_discovery=False, static_discovery=True)
+
+def guess_mime_type(file_title: Optional[str]) -> Optional[str]:
+    if not file_title:
+        return None
+    mime_type, _ = mimetypes.guess_type(file_title)
+    if mime_type and (mime_type == 'application/pdf' or mime_type.startswith('image/')):
+        return mime_type
+    return None
+
+def download_drive_file(drive_service, creds, file_id: str, file_title: Optional[str]):
+    http = google_auth_httplib2.AuthorizedHttp(creds, http=_thread_http())
+
+    request_media = drive_service.files().get_media(fileId=file_id)
+    request_media.http = http
+    fh = _HashingBytesIO()
+    downloader = MediaIoBaseDownload(fh, request_media)
+    done = False
+    while not done:
+        status, done = downloader.next_chunk(num_retries=_DRIVE_RETRIES)
+    file_bytes = fh.getvalue()
+    fhash = fh.sha256.hexdigest()
+
+    # The bytes are authoritative (uploads are often misnamed); the title's
+    # extension is the fallback. Neither needs a Drive metadata round trip.
+    mime_type = sniff_mime_type(file_bytes) or guess_mime_type(file_title)
+    return file_bytes, fhash, mime_type, file_title
+
+def extract_attachment_text(file_bytes: bytes, mime_type: Optional[str], file_title: Optional[str]) -> str:
+    try:
+        return extract_text_from_file(file_bytes, mime_type)
+    except Exception as e:
+        logger.error(f"Text extraction failed for {file_title}: {e}")
+        logger.error(traceback.format_exc())
+        return ""
+
+def analyze_attachment(domain: str, part_question: str, ocr_text: str, attachment_name: str, att_idx: int) -> dict:
+    try:
+        if not ocr_text.strip():
+            return {
+                'score': 0.0,
+                'justification': f'Attachment {attachment_name} OCR empty.'
+            }
+        if domain == 'theory':
+            return analyze_theory_submission(part_question, ocr_text)
+        return analyze_programming_submission(part_question, ocr_text)
+    except Exception as e:
+        logger.error(f"Analyzer failed for attachment {att_idx}: {e}")
+        logger.error(traceback.format_exc())
+        return {'score': 0.0, 'justification': f'Analyzer error: {e}'}
+
+def cached_hash_owner(assignment_id: str, fhash: str) -> Optional[Tuple[str, str]]:
+    key = (assignment_id, fhash)
+    with _hash_owners_lock:
+        entry = _hash_owners.get(key)
+        if entry is None:
+            return None
+        if entry[2] < time.monotonic():
+            del _hash_owners[key]
+            return None
+        _hash_owners.move_to_end(key)
+        return entry[0], entry[1]
+
+def remember_hash_owner(assignment_id: str, file_hashes: List[str], student_id: str, doc_id: str):
+    expires = time.monotonic() + _HASH_OWNER_TTL
+    with _hash_owners_lock:
+        for fhash in file_hashes:
+            key = (assignment_id, fhash)
+            _hash_owners[key] = (student_id, doc_id, expires)
+            _hash_owners.move_to_end(key)
+        while len(_hash_owners) > _HASH_OWNER_CACHE_SIZE:
+            _hash_owners.popitem(last=False)
+
+def plagiarism_index_ref(assignment_id: str, fhash: str):
+    return db.collection(_PLAGIARISM_INDEX_COLLECTION).document(f"{assignment_id}_{fhash}")
+
+def index_file_hashes(assignment_id: str, file_hashes: List[str], student_id: str, doc_id: str) -> List[str]:
+    # create() fails if the entry exists, so the first submitter of a file keeps it.
+    # Returns the hashes whose entries were created here.
+    created = []
+    for fhash in dict.fromkeys(file_hashes):
+        if fhash in _TRIVIAL_HASHES:
+            continue
+        try:
+            plagiarism_index_ref(assignment_id, fhash).create({'student_id': student_id, 'result_doc_id': doc_id})
+            created.append(fhash)
+        except AlreadyExists:
+            pass
+    return created
+
+def find_exact_match(assignment_id: str, student_id: str, file_hashes: List[str]) -> Tuple[Optional[dict], List[str]]:
+    """
+    Returns (the first other student's result sharing one of file_hashes or None,
+    the hashes that have no plagiarism_index entry yet).
+    """
+    unchecked = []
+    for fhash in dict.fromkeys(file_hashes):
+        if fhash in _TRIVIAL_HASHES:
+            continue
+        owner = cached_hash_owner(assignment_id, fhash)
+        if owner is None:
+            unchecked.append(fhash)
+        elif owner[0] != student_id:
+            return {'matched_student': owner[0], 'matched_doc_id': owner[1], 'matched_hash': fhash}, []
+    if not unchecked:
+        return None, []
+
+    # One batched read for every index entry; get_all may return them in any order.
+    refs = {f"{assignment_id}_{fhash}": fhash for fhash in unchecked}
+    owners = {}
+    for snap in db.get_all([plagiarism_index_ref(assignment_id, fhash) for fhash in unchecked]):
+        if snap.exists:
+            owners[refs[snap.id]] = snap.to_dict()
+    unindexed = [fhash for fhash in unchecked if fhash not in owners]
+    for fhash, owner in owners.items():
+        # Index entries are authoritative, so warm the cache with whoever they name.
+        if owner.get('student_id'):
+            remember_hash_owner(assignment_id, [fhash], owner['student_id'], owner.get('result_doc_id'))
+    for fhash in unchecked:
+        owner = owners.get(fhash)
+        if owner and owner.get('student_id') != student_id:
+            return {'matched_student': owner.get('student_id'), 'matched_doc_id': owner.get('result_doc_id'), 'matched_hash': fhash}, unindexed
+    if _PLAGIARISM_INDEX_ONLY:
+        return None, unindexed
+
+    for start in range(0, len(unindexed), _ARRAY_CONTAINS_ANY_LIMIT):
+        chunk = unindexed[start:start + _ARRAY_CONTAINS_ANY_LIMIT]
+        q = (
+            db.collection('results')
+            .where(filter={"field_path": "assignment_id", "op_string": "==", "value": assignment_id})
+            .where(filter={"field_path": "file_hashes", "op_string": "array_contains_any", "value": chunk})
+        )
+        for doc in q.stream():
+            prev = doc.to_dict()
+            prev_student = prev.get('student_id')
+            if not prev_student or prev_student == student_id:
+                continue
+            prev_hashes = set(prev.get('file_hashes') or [])
+            fhash = next((h for h in chunk if h in prev_hashes), None)
+            return {'matched_student': prev_student, 'matched_doc_id': doc.id, 'matched_hash': fhash}, unindexed
+    return None, unindexed
+
+def write_result(doc_ref, course_id: str, student_id: str, assignment_id: str, justification: str,
+                 accuracy_score: float = 0.0, debug_info: Optional[str] = None,
+                 file_hashes: Optional[List[str]] = None, is_plagiarized: bool = False, batch=None, **fields):
+    # Full replace rather than merge: a resubmission must not inherit stale part results.
+    doc = {
+        'course_id': course_id,
+        'student_id': student_id,
+        'assignment_id': assignment_id,
+        'accuracy_score': accuracy_score,
+        'justification': justification,
+    }
+    if debug_info is not None:
+        doc['debug_info'] = debug_info
+    doc.update(fields)
+    doc['file_hashes'] = file_hashes or []
+    doc['is_plagiarized'] = is_plagiarized
+    if batch is not None:
+        batch.set(doc_ref, doc)
+    else:
+        doc_ref.set(doc)
+
+def _log_write_failure(future):
+    e = future.exception()
+    if e is not None:
+        logger.error(f"Background Firestore write failed: {e}")
+
+def load_cached_ocr(file_hashes: List[str]) -> Dict[str, str]:
+    refs = [db.collection(_OCR_CACHE_COLLECTION).document(h) for h in dict.fromkeys(file_hashes)]
+    if not refs:
+        return {}
+    try:
+        snaps = db.get_all(refs, field_paths=['ocr_text'])
+        return {snap.id: snap.get('ocr_text') for snap in snaps if snap.exists}
+    except Exception as e:
+        logger.error(f"OCR cache lookup failed: {e}")
+        return {}
+
+def store_cached_ocr(fhash: str, ocr_text: str, mime_type: Optional[str]):
+    # Empty text may be a transient OCR failure, so only real text is cached.
+    if not ocr_text.strip() or len(ocr_text.encode('utf-8')) > _OCR_CACHE_MAX_BYTES:
+        return
+    db.collection(_OCR_CACHE_COLLECTION).document(fhash).set({'ocr_text': ocr_text, 'mime_type': mime_type})
+
+def best_part(text: str, layout) -> int:
+    _, q_vocab, token_parts, part_sizes = layout
+    counts = [0] * len(part_sizes)
+    for w in token_set(text) & q_vocab:
+        for j in token_parts[w]:
+            counts[j] += 1
+    scores = [c / n for c, n in zip(counts, part_sizes)]
+    return max(range(len(scores)), key=scores.__getitem__)
+
+def grade_attachments(downloads: list, attachment_names: List[str], domain: str,
+                      layout) -> Tuple[Dict[int, int], Dict[int, dict]]:
+    """
+    OCRs, maps and grades attachments as a pipeline: each file is handed to the
+    analyzer as soon as its text is ready rather than after the slowest OCR.
+    Returns (attachment index -> part index, attachment index -> analyzer result),
+    both in attachment order.
+    """
+    if not downloads:
+        return {}, {}
+    question_parts = layout[0]
+    # One attachment per part is taken to be in question order.
+    in_order = len(downloads) == len(question_parts)
+
+    # Identical files are looked up / OCR'd once and shared by every copy.
+    copies: Dict[str, List[int]] = {}
+    for att_idx, d in enumerate(downloads):
+        copies.setdefault(d[1], []).append(att_idx)
+    known_texts = load_cached_ocr(list(copies))
+
+    mapping: Dict[int, int] = {}
+    job_keys: Dict[int, Tuple[int, bytes]] = {}
+    jobs = {}
+    with ThreadPoolExecutor(max_workers=_OCR_WORKERS) as ocr_pool, \
+            ThreadPoolExecutor(max_workers=_ANALYZER_WORKERS) as analyzer_pool:
+
+        def text_ready(att_idx: int, text: str):
+            part_idx = att_idx if in_order else best_part(text, layout)
+            mapping[att_idx] = part_idx
+            # The same text mapped to the same part (e.g. one PDF attached twice)
+            # grades identically, so each distinct (part, text) pair is analyzed once.
+            key = (part_idx, hashlib.blake2b(text.encode('utf-8', errors='ignore'), digest_size=16).digest())
+            job_keys[att_idx] = key
+            if key not in jobs:
+                jobs[key] = analyzer_pool.submit(
+                    analyze_attachment, domain, question_parts[part_idx], text,
+                    attachment_names[att_idx], att_idx
+                )
+
+        ocr_jobs = {}
+        for fhash, att_idxs in copies.items():
+            if fhash in known_texts:
+                for att_idx in att_idxs:
+                    text_ready(att_idx, known_texts[fhash])
+            else:
+                d = downloads[att_idxs[0]]
+                ocr_jobs[ocr_pool.submit(extract_attachment_text, d[0], d[2], d[3])] = fhash
+
+        for future in as_completed(ocr_jobs):
+            fhash = ocr_jobs[future]
+            text = future.result()
+            mime_type = downloads[copies[fhash][0]][2]
+            _WRITE_POOL.submit(store_cached_ocr, fhash, text, mime_type).add_done_callback(_log_write_failure)
+            for att_idx in copies[fhash]:
+                text_ready(att_idx, text)
+
+        order = sorted(mapping)
+        return (
+            {att_idx: mapping[att_idx] for att_idx in order},
+            {att_idx: jobs[job_keys[att_idx]].result() for att_idx in order},
+        )
+
 # ----------------- Routes -----------------
 @app.route('/health', methods=['GET'])
 def health_check():
@@ -95,175 +481,77 @@ def run_task_logic(payload: dict) -> dict:
 
     # ----------------- Drive Auth -----------------
     try:
-        creds = google.oauth2.credentials.Credentials(**credentials_info)
-        drive_service = build('drive', 'v3', credentials=creds, cache_discovery=False)
+        creds = get_credentials(credentials_info)
+        drive_service = get_drive_service()
     except Exception as e:
         logger.error(f"Drive auth failed: {e}")
         logger.error(traceback.format_exc())
-        doc_ref.set({
-            'course_id': course_id,
-            'student_id': student_id,
-            'assignment_id': assignment_id,
-            'accuracy_score': 0.0,
-            'justification': 'Worker failed to authenticate to Drive.',
-            'debug_info': str(e),
-            'file_hashes': [],
-            'is_plagiarized': False
-        })
+        write_result(doc_ref, course_id, student_id, assignment_id,
+                     'Worker failed to authenticate to Drive.', debug_info=str(e))
         return {'error': 'drive auth failed'}, 500
 
     if len(attachments) == 0:
         logger.warning("No attachments found for assignment %s", assignment_id)
-        doc_ref.set({
-            'course_id': course_id,
-            'student_id': student_id,
-            'assignment_id': assignment_id,
-            'accuracy_score': 0.0,
-            'justification': "No submission found.",
-            'debug_info': '',
-            'file_hashes': [],
-            'is_plagiarized': False
-        })
+        write_result(doc_ref, course_id, student_id, assignment_id,
+                     "No submission found.", debug_info='')
         return {'status': 'no_attachments'}, 200
 
     # ----------------- Download Attachments -----------------
-    ocr_texts, file_hashes, attachment_names = [], [], []
+    downloads, file_hashes, attachment_names = [], [], []
     try:
+        drive_files = []
         for att in attachments:
-            drive_file = att.get('driveFile') or att.get('drive_file') or att
-            file_id = None
-            file_title = None
-            if isinstance(drive_file, dict):
-                file_id = drive_file.get('id')
-                file_title = drive_file.get('title') or drive_file.get('name')
+            file_id, file_title = attachment_file(att)
             if not file_id:
                 logger.warning("Attachment missing file_id, skipping: %s", att)
                 continue
+            drive_files.append((file_id, file_title))
 
-            request_media = drive_service.files().get_media(fileId=file_id)
-            fh = io.BytesIO()
-            downloader = MediaIoBaseDownload(fh, request_media)
-            done = False
-            while not done:
-                status, done = downloader.next_chunk()
-            file_bytes = fh.getvalue()
+        if drive_files:
+            # Fetch all files at once; results come back in attachment order.
+            downloads = list(_DOWNLOAD_POOL.map(
+                lambda f: download_drive_file(drive_service, creds, f[0], f[1]),
+                drive_files
+            ))
 
-            fhash = hashlib.sha256(file_bytes).hexdigest()
+        for (file_id, _), (_, fhash, _, file_title) in zip(drive_files, downloads):
             file_hashes.append(fhash)
-
-            try:
-                meta = drive_service.files().get(fileId=file_id, fields='mimeType,name').execute()
-                mime_type = meta.get('mimeType')
-                if not file_title:
-                    file_title = meta.get('name')
-            except Exception as e:
-                logger.error(f"Metadata fetch failed for {file_id}: {e}")
-                mime_type = None
-
-            try:
-                text = extract_text_from_file(file_bytes, mime_type)
-            except Exception as e:
-                logger.error(f"Text extraction failed for {file_title}: {e}")
-                logger.error(traceback.format_exc())
-                text = ""
-            ocr_texts.append(text)
             attachment_names.append(file_title or f"file_{file_id}")
     except Exception as e:
         logger.error(f"Attachment download failed: {e}")
         logger.error(traceback.format_exc())
-        doc_ref.set({
-            'course_id': course_id,
-            'student_id': student_id,
-            'assignment_id': assignment_id,
-            'accuracy_score': 0.0,
-            'justification': 'Worker failed while downloading attachments.',
-            'debug_info': str(e),
-            'file_hashes': file_hashes,
-            'is_plagiarized': False
-        })
+        write_result(doc_ref, course_id, student_id, assignment_id,
+                     'Worker failed while downloading attachments.', debug_info=str(e),
+                     file_hashes=file_hashes)
         return {'error': 'download_failed'}, 500
 
     # ----------------- Exact File Plagiarism -----------------
+    # Without a successful lookup, every hash is a candidate for a new index entry.
+    unindexed = [h for h in dict.fromkeys(file_hashes) if h not in _TRIVIAL_HASHES]
+    lookup_ok = False
     try:
-        for fhash in file_hashes:
-            q = (
-                db.collection('results')
-                .where(filter={"field_path": "assignment_id", "op_string": "==", "value": assignment_id})
-                .where(filter={"field_path": "file_hashes", "op_string": "array_contains", "value": fhash})
-                .limit(1)
-            )
-            docs = list(q.stream())
-            if docs:
-                prev = docs[0].to_dict()
-                prev_student = prev.get('student_id')
-                if prev_student and prev_student != student_id:
-                    logger.warning("Plagiarism detected: %s matches %s", student_id, prev_student)
-                    doc_ref.set({
-                        'course_id': course_id,
-                        'student_id': student_id,
-                        'assignment_id': assignment_id,
-                        'accuracy_score': 0.0,
-                        'justification': 'Plagiarism detected (exact file match).',
-                        'debug_info': json.dumps({
-                            'matched_student': prev_student,
-                            'matched_doc_id': docs[0].id,
-                            'matched_hash': fhash
-                        }),
-                        'file_hashes': file_hashes,
-                        'is_plagiarized': True
-                    })
-                    return {'status': 'plagiarism_detected'}, 200
+        match, unindexed = find_exact_match(assignment_id, student_id, file_hashes)
+        lookup_ok = True
+        if match:
+            logger.warning("Plagiarism detected: %s matches %s", student_id, match['matched_student'])
+            write_result(doc_ref, course_id, student_id, assignment_id,
+                         'Plagiarism detected (exact file match).', debug_info=json.dumps(match),
+                         file_hashes=file_hashes, is_plagiarized=True)
+            return {'status': 'plagiarism_detected'}, 200
     except Exception as e:
         logger.error(f"Plagiarism check failed: {e}")
         logger.error(traceback.format_exc())
 
-    # ----------------- Match Attachments to Question Parts -----------------
-    question_parts = split_question_into_parts(question)
-    num_parts = len(question_parts)
+    # ----------------- Extract, Match and Analyze -----------------
+    # After the plagiarism check, so copied submissions never reach OCR.
+    layout = question_layout(question)
+    num_parts = len(layout[0])
+    mapping, analyses = grade_attachments(downloads, attachment_names, domain, layout)
 
-    mapping = {}
-    if len(ocr_texts) == num_parts:
-        for i in range(num_parts):
-            mapping[i] = i
-    else:
-        q_tokens = [token_set(qp) for qp in question_parts]
-        for i, txt in enumerate(ocr_texts):
-            p_tokens = token_set(txt)
-            best_j, best_score = 0, -1.0
-            for j, qt in enumerate(q_tokens):
-                score = len(p_tokens & qt) / max(1, len(qt)) if qt else 0.0
-                if score > best_score:
-                    best_score, best_j = score, j
-            mapping[i] = best_j
-
-    # ----------------- Analyze Submissions -----------------
     part_results: Dict[int, dict] = {}
     part_sources: Dict[int, Optional[int]] = {}
-
     for att_idx, part_idx in mapping.items():
-        try:
-            ocr_text = ocr_texts[att_idx]
-            if not ocr_text.strip():
-                result = {
-                    'score': 0.0,
-                    'justification': f'Attachment {attachment_names[att_idx]} OCR empty.'
-                }
-            else:
-                if domain == 'theory':
-                    result = analyze_theory_submission(
-                        question_parts[part_idx] if part_idx < len(question_parts) else question,
-                        ocr_text
-                    )
-                else:
-                    result = analyze_programming_submission(
-                        question_parts[part_idx] if part_idx < len(question_parts) else question,
-                        ocr_text
-                    )
-        except Exception as e:
-            logger.error(f"Analyzer failed for attachment {att_idx}: {e}")
-            logger.error(traceback.format_exc())
-            result = {'score': 0.0, 'justification': f'Analyzer error: {e}'}
-
+        result = analyses[att_idx]
         score = float(result.get('score', 0.0))
         if part_idx not in part_results or score > float(part_results[part_idx].get('score', 0.0)):
             part_results[part_idx] = result
@@ -291,20 +579,36 @@ def run_task_logic(payload: dict) -> dict:
 
     final_justification = " | ".join(per_part_justifications)
 
-    result_payload = {
-        'course_id': course_id,
-        'student_id': student_id,
-        'assignment_id': assignment_id,
-        'accuracy_score': final_score,
-        'justification': final_justification,
-        'part_results': part_results,
-        'part_sources': part_sources,
-        'file_hashes': file_hashes,
-        'is_plagiarized': False
-    }
-
+    result_fields = dict(accuracy_score=final_score, part_results=part_results,
+                         part_sources=part_sources, file_hashes=file_hashes)
     try:
-        doc_ref.set(result_payload)
+        # The result and its new plagiarism_index entries land in one commit.
+        batch = db.batch()
+        write_result(doc_ref, course_id, student_id, assignment_id, final_justification,
+                     batch=batch, **result_fields)
+        for fhash in unindexed:
+            batch.create(plagiarism_index_ref(assignment_id, fhash),
+                         {'student_id': student_id, 'result_doc_id': doc_id})
+        batch.commit()
+        # Only entries this task created are known to be ours, and only after a
+        # full lookup: otherwise the file may belong to an earlier unindexed result.
+        if lookup_ok:
+            remember_hash_owner(assignment_id, unindexed, student_id, doc_id)
+    except AlreadyExists:
+        # Another submission indexed one of these files after our lookup; save the
+        # result on its own and let index_file_hashes keep whichever entries it can.
+        try:
+            write_result(doc_ref, course_id, student_id, assignment_id, final_justification, **result_fields)
+        except Exception as e:
+            logger.error(f"Firestore write failed: {e}")
+            logger.error(traceback.format_exc())
+            return {'error': 'db_write_failed', 'detail': str(e)}, 500
+        try:
+            created = index_file_hashes(assignment_id, unindexed, student_id, doc_id)
+            if lookup_ok:
+                remember_hash_owner(assignment_id, created, student_id, doc_id)
+        except Exception as e:
+            logger.error(f"Plagiarism index write failed: {e}")
     except Exception as e:
         logger.error(f"Firestore write failed: {e}")
         logger.error(traceback.format_exc())